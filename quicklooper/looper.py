@@ -75,18 +75,33 @@ class Looper:
         """
         pass
 
+    def _wait(self, timeout: float) -> bool:
+        """Blocks the loop thread for up to timeout seconds, returns True if self.stop has been called
+
+        Only override this method to substitute a different clock, e.g. a virtual clock in tests
+        """
+        return self._exit_event.wait(timeout=timeout)
+
+    def _run_one_iteration(self) -> None:
+        """Calls self.main once with the main args and kwargs passed to __init__
+
+        Called by self._tick each loop, and may be called directly to step the loop without starting the thread,
+        e.g. in tests. Do not override this method
+        """
+        self.main(*self._main_args, **self._main_kwargs)
+
     def _tick(self) -> None:
         """Runs in the main thread, and calls self.main eery self._interval seconds until self.stop is called
 
         Do not override this method
         """
         if self._run_before_first_wait:
-            self.main(*self._main_args, **self._main_kwargs)
+            self._run_one_iteration()
         while True:
-            if self._exit_event.wait(timeout=self._interval):
+            if self._wait(self._interval):
                 break
             else:
-                self.main(*self._main_args, **self._main_kwargs)
+                self._run_one_iteration()
 
     def start(self) -> None:
         """Call this method to run start up tasks in self.start_up and then begin the main loop
@@ -1,273 +1,408 @@
-from typing import Iterator
-import collections
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 import itertools
+import threading
 import time
 import unittest
 
 from quicklooper import Looper
 
-
-class Counter:
-    """Simple Counter class has attribute self.count that starts at 0, and is incremented by 1 on each call to
-    self.increment"""
-    def __init__(self):
-        self.count = 0
-
-    def reset(self):
-        self.count = 0
-
-    def increment(self):
-        self.count += 1
+INTERVAL = 0.1  # virtual seconds between loops
+LOOPS = 4  # number of intervals the clock is advanced by in each test
 
 
 class MessageQueue:
-    """Simple MessageQueue class with push and pop methods for str messages
+    """Simple MessageQueue class with push and pop methods for str messages, stored in a ring buffer
     Raises IndexError if pop is called when MessageQueue is empty
     """
     def __init__(self):
-        self._messages = collections.deque()
+        # capacity is kept a power of 2, so that buffer indices can be masked rather than taken modulo capacity
+        self._buf: List[Optional[str]] = [None] * 16
+        self._mask = 15
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self) -> int:
+        return self._tail - self._head
 
     def push(self, msg: str) -> None:
-        self._messages.append(msg)
+        if len(self) == len(self._buf):
+            self._grow()
+        self._buf[self._tail & self._mask] = msg
+        self._tail += 1
 
     def pop(self) -> str:
-        return self._messages.popleft()
+        if not self:
+            raise IndexError('pop from an empty MessageQueue')
+        index = self._head & self._mask
+        msg = self._buf[index]
+        assert msg is not None
+        self._buf[index] = None
+        self._head += 1
+        return msg
+
+    def _grow(self) -> None:
+        capacity = len(self._buf)
+        self._buf = [self._buf[i & self._mask] for i in range(self._head, self._tail)] + [None] * capacity
+        self._mask = 2 * capacity - 1
+        self._tail -= self._head
+        self._head = 0
+
+
+class FakeClock:
+    """Virtual clock for driving a Looper without real sleeps
+
+    The loop thread blocks in self.wait until self.advance moves virtual time up to its deadline. self.advance steps
+    through every deadline it passes, and returns only once the loop thread has run main for each of them and is
+    waiting again, so loop counts are deterministic
+    """
+    def __init__(self):
+        self._now = 0.0
+        self._deadline: Optional[float] = None  # deadline of the waiting loop thread, None while it is running
+        self._condition = threading.Condition()
+
+    def wait(self, exit_event: threading.Event, timeout: float) -> bool:
+        with self._condition:
+            deadline = self._deadline = self._now + timeout
+            self._condition.notify_all()
+            while not exit_event.is_set() and self._now < deadline:
+                # short real timeout so that Looper.stop, which only sets exit_event, is noticed promptly
+                self._condition.wait(timeout=0.005)
+            self._deadline = None
+            self._condition.notify_all()
+            return exit_event.is_set()
+
+    def _wait_for_loop_thread(self) -> None:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._deadline is not None and self._now < self._deadline,
+                                            timeout=1.0):
+                raise RuntimeError('Looper thread did not start waiting')
+
+    def advance(self, seconds: float) -> None:
+        target = self._now + seconds
+        self._wait_for_loop_thread()
+        while True:
+            with self._condition:
+                if target < self._deadline:
+                    self._now = target
+                    return
+                self._now = self._deadline
+                self._condition.notify_all()
+            self._wait_for_loop_thread()
+
+
+def _do_nothing(*args, **kwargs) -> None:
+    pass
+
+
+class _ConfigurableLooper(Looper):
+    """Looper which waits on a FakeClock instead of real time if one is passed in, and dispatches main, on_start_up
+    and on_shut_down to the callables passed in, so that each test does not need to define its own Looper subclass
+    """
+    def __init__(self,
+                 *args: Any,
+                 clock: Optional[FakeClock] = None,
+                 main_fn: Callable[..., None] = _do_nothing,
+                 start_up_fn: Callable[..., None] = _do_nothing,
+                 shut_down_fn: Callable[..., None] = _do_nothing,
+                 **kwargs: Any,
+                 ):
+        super().__init__(*args, **kwargs)
+        self._clock = clock
+        self._main_fn = main_fn
+        self._start_up_fn = start_up_fn
+        self._shut_down_fn = shut_down_fn
 
+    def on_start_up(self, *args, **kwargs):
+        self._start_up_fn(*args, **kwargs)
 
-class TestLooper(unittest.TestCase):
-    def test_interval_with_run_before_first_wait(self):
-        counter = Counter()
+    def on_shut_down(self, *args, **kwargs):
+        self._shut_down_fn(*args, **kwargs)
 
-        class CounterLooper(Looper):
-            def main(self):
-                counter.increment()
+    def main(self, *args, **kwargs):
+        self._main_fn(*args, **kwargs)
 
-        counter_looper = CounterLooper(interval=0.1)
-        # runs loop once immediately, because run_before_first_wait == True (default)
-        counter_looper.start()
-        # give time to complete 4 additional loops
-        time.sleep(0.45)
-        counter_looper.stop()
-        # loop has completed 5 times
-        self.assertEqual(5, counter.count)
+    def _wait(self, timeout: float) -> bool:
+        if self._clock is None:
+            # real time wait, exercised by TestLooper.test_real_clock
+            return super()._wait(timeout)
+        return self._clock.wait(self._exit_event, timeout)
 
-    def test_interval_without_run_before_first_wait(self):
-        counter = Counter()
 
-        class CounterLooper(Looper):
-            _interval = 0.1
+def drain(msg_queue: MessageQueue) -> Tuple[str, ...]:
+    """Pops every message from msg_queue, returning them in order"""
+    return tuple(msg_queue.pop() for _ in range(len(msg_queue)))
 
-            def main(self):
-                counter.increment()
 
-        counter.reset()
-        counter_looper = CounterLooper(run_before_first_wait=False)
-        # does not run loop immediately, because run_before_first_wait == False
+def message_generator() -> Iterator[str]:
+    msg_count = itertools.count(1)
+    while True:
+        yield f'Message {next(msg_count)}'
+
+
+class TestLooper(unittest.TestCase):
+    def test_real_clock(self):
+        loop_count = [0]
+        shut_down_count = [0]
+
+        def count_loop():
+            loop_count[0] += 1
+
+        def count_shut_down():
+            shut_down_count[0] += 1
+
+        # no clock, so the looper waits on its exit event in real time
+        counter_looper = _ConfigurableLooper(interval=0.01, main_fn=count_loop, shut_down_fn=count_shut_down)
+        started = time.monotonic()
         counter_looper.start()
-        # give time to complete 4 loops
-        time.sleep(0.45)
+        # main runs once immediately, and a second time only after a real wait has timed out
+        while loop_count[0] < 2 and time.monotonic() - started < 1.0:
+            time.sleep(0.001)
         counter_looper.stop()
-        # loop has completed 4 times
-        self.assertEqual(4, counter.count)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertGreaterEqual(loop_count[0], 2)
+        self.assertEqual(1, shut_down_count[0])
+
+    def test_interval(self):
+        counts = {}
+        for run_before_first_wait in (True, False):
+            with self.subTest(run_before_first_wait=run_before_first_wait):
+                clock = FakeClock()
+                count = [0]
+
+                def count_loop():
+                    count[0] += 1
+
+                counter_looper = _ConfigurableLooper(interval=INTERVAL, run_before_first_wait=run_before_first_wait,
+                                                     clock=clock, main_fn=count_loop)
+                # runs loop once immediately only if run_before_first_wait == True
+                counter_looper.start()
+                # advance the clock to complete LOOPS loops
+                for _ in range(LOOPS):
+                    clock.advance(INTERVAL)
+                counter_looper.stop()
+                counts[run_before_first_wait] = count[0]
+                self.assertEqual(LOOPS + 1 if run_before_first_wait else LOOPS, count[0])
+        # only compare the variants if neither failed before its count was recorded
+        if len(counts) == 2:
+            # run_before_first_wait adds exactly one call to main
+            self.assertEqual(1, counts[True] - counts[False])
+
+    def test_interval_class_attributes(self):
+        for run_before_first_wait, expected_count in ((True, LOOPS + 1), (False, LOOPS)):
+            with self.subTest(run_before_first_wait=run_before_first_wait):
+                clock = FakeClock()
+                count = [0]
+
+                def count_loop():
+                    count[0] += 1
+
+                class ClassAttributeLooper(_ConfigurableLooper):
+                    _interval = INTERVAL
+                    _run_before_first_wait = run_before_first_wait
+
+                counter_looper = ClassAttributeLooper(clock=clock, main_fn=count_loop)
+                # runs loop once immediately only if _run_before_first_wait == True
+                counter_looper.start()
+                # advance the clock to complete LOOPS loops
+                for _ in range(LOOPS):
+                    clock.advance(INTERVAL)
+                counter_looper.stop()
+                self.assertEqual(expected_count, count[0])
 
     def test_on_startup(self):
-        hit_counter = Counter()
-        loop_counter = Counter()
+        clock = FakeClock()
+        hit_count = [0]
+        loop_count = [0]
 
-        class CounterLooper(Looper):
-            def on_start_up(self, *args, **kwargs):
-                hit_counter.increment()
+        def count_hit():
+            hit_count[0] += 1
 
-            def main(self):
-                loop_counter.increment()
+        def count_loop():
+            loop_count[0] += 1
 
-        counter_looper = CounterLooper(interval=0.1)
+        counter_looper = _ConfigurableLooper(interval=INTERVAL, clock=clock, main_fn=count_loop, start_up_fn=count_hit)
         # calls counter_looper.on_start_up, calls main once immediately, and then enters loop
         counter_looper.start()
-        # give time to allow for 4 loops
-        time.sleep(0.45)
+        # advance the clock to allow for LOOPS loops
+        for _ in range(LOOPS):
+            clock.advance(INTERVAL)
         counter_looper.stop()
-        # hit_counter incremented once on startup
-        self.assertEqual(1, hit_counter.count)
-        # loop has completed 5 times
-        self.assertEqual(5, loop_counter.count)
+        # hit_count incremented once on startup
+        self.assertEqual(1, hit_count[0])
+        # main called once before the first wait, then once per loop
+        self.assertEqual(LOOPS + 1, loop_count[0])
 
     def test_on_startup_with_args(self):
-        hit_counter = Counter()
-        loop_counter = Counter()
+        clock = FakeClock()
+        hit_count = [0]
+        loop_count = [0]
 
-        class CounterLooper(Looper):
-            def on_start_up(self, increment_by: int):
-                for _ in range(increment_by):
-                    hit_counter.increment()
+        def increment_hit_count(increment_by: int):
+            hit_count[0] += increment_by
 
-            def main(self):
-                loop_counter.increment()
+        def count_loop():
+            loop_count[0] += 1
 
-        counter_looper = CounterLooper(interval=0.1, start_up_args=[10])
+        counter_looper = _ConfigurableLooper(interval=INTERVAL, start_up_args=[10], clock=clock, main_fn=count_loop,
+                                             start_up_fn=increment_hit_count)
         # calls counter_looper.on_start_up, calls main once immediately, and then enters loop
         counter_looper.start()
-        # give time to allow for 4 loops
-        time.sleep(0.45)
+        # advance the clock to allow for LOOPS loops
+        for _ in range(LOOPS):
+            clock.advance(INTERVAL)
         counter_looper.stop()
-        # hit_counter incremented 10 times on startup
-        self.assertEqual(10, hit_counter.count)
-        # loop has completed 5 times
-        self.assertEqual(5, loop_counter.count)
+        # hit_count incremented 10 times on startup
+        self.assertEqual(10, hit_count[0])
+        # main called once before the first wait, then once per loop
+        self.assertEqual(LOOPS + 1, loop_count[0])
 
     def test_on_startup_with_kwargs(self):
-        hit_counter = Counter()
-        loop_counter = Counter()
+        clock = FakeClock()
+        hit_count = [0]
+        loop_count = [0]
 
-        class CounterLooper(Looper):
-            def on_start_up(self, increment_by: int, some_counter: Counter):
-                for _ in range(increment_by):
-                    some_counter.increment()
+        def increment_some_count(increment_by: int, some_count: List[int]):
+            some_count[0] += increment_by
 
-            def main(self):
-                loop_counter.increment()
+        def count_loop():
+            loop_count[0] += 1
 
-        counter_looper = CounterLooper(interval=0.1, start_up_args=[10], start_up_kwargs={'some_counter': hit_counter})
+        counter_looper = _ConfigurableLooper(interval=INTERVAL, start_up_args=[10],
+                                             start_up_kwargs={'some_count': hit_count}, clock=clock,
+                                             main_fn=count_loop, start_up_fn=increment_some_count)
         # calls counter_looper.on_start_up, calls main once immediately, and then enters loop
         counter_looper.start()
-        # give time to allow for 4 loops
-        time.sleep(0.45)
+        # advance the clock to allow for LOOPS loops
+        for _ in range(LOOPS):
+            clock.advance(INTERVAL)
         counter_looper.stop()
-        # hit_counter incremented 10 times on startup
-        self.assertEqual(10, hit_counter.count)
-        # loop has completed 5 times
-        self.assertEqual(5, loop_counter.count)
+        # hit_count incremented 10 times on startup
+        self.assertEqual(10, hit_count[0])
+        # main called once before the first wait, then once per loop
+        self.assertEqual(LOOPS + 1, loop_count[0])
 
     def test_on_shutdown(self):
-        hit_counter = Counter()
-        loop_counter = Counter()
+        clock = FakeClock()
+        hit_count = [0]
+        loop_count = [0]
 
-        class CounterLooper(Looper):
-            def on_start_up(self):
-                hit_counter.increment()
+        def count_hit():
+            hit_count[0] += 1
 
-            def main(self):
-                loop_counter.increment()
+        def reset_hit_count():
+            hit_count[0] = 0
 
-            def on_shut_down(self):
-                hit_counter.reset()
+        def count_loop():
+            loop_count[0] += 1
 
-        counter_looper = CounterLooper(interval=0.1)
+        counter_looper = _ConfigurableLooper(interval=INTERVAL, clock=clock, main_fn=count_loop, start_up_fn=count_hit,
+                                             shut_down_fn=reset_hit_count)
         # calls counter_looper.on_start_up, calls main once immediately, and then enters loop
         counter_looper.start()
-        # hit_counter incremented on startup
-        self.assertEqual(1, hit_counter.count)
-        # give time to allow for 4 loops
-        time.sleep(0.45)
+        # hit_count incremented on startup
+        self.assertEqual(1, hit_count[0])
+        # advance the clock to allow for LOOPS loops
+        for _ in range(LOOPS):
+            clock.advance(INTERVAL)
         # calls on_shut_down
         counter_looper.stop()
-        # hit_counter was reset on shutdown
-        self.assertEqual(0, hit_counter.count)
-        self.assertEqual(5, loop_counter.count)
+        # hit_count was reset on shutdown
+        self.assertEqual(0, hit_count[0])
+        self.assertEqual(LOOPS + 1, loop_count[0])
 
-    def test_on_shutdown_with_args(self):
-        loop_counter = Counter()
-        msg_queue = MessageQueue()
-
-        class CounterLooper(Looper):
-            def main(self):
-                loop_counter.increment()
 
-            def on_shut_down(self, msg: str):
-                msg_queue.push(msg)
+class TestLooperShutDownArgs(unittest.TestCase):
+    """Runs one looper with both shut_down_args and shut_down_kwargs in setUpClass, tests assert on the cached
+    results"""
+    messages: Tuple[str, ...]
+    loop_count: int
+    empty_before_stop: bool
 
-        counter_looper = CounterLooper(interval=0.2, shut_down_args=['Finished!'])
-        # calls counter_looper.on_start_up, calls main once immediately, and then enters loop
-        counter_looper.start()
-        # assert the message queue is empty
-        self.assertRaises(IndexError, msg_queue.pop)
-        # give time to allow for 4 loops
-        time.sleep(0.85)
-        # calls on_shut_down
-        counter_looper.stop()
-        self.assertEqual(5, loop_counter.count)
-        # msg was added to queue on shutdown
-        self.assertEqual('Finished!', msg_queue.pop())
-
-    def test_on_shutdown_with_kwargs(self):
-        loop_counter = Counter()
+    @classmethod
+    def setUpClass(cls):
+        clock = FakeClock()
         msg_queue = MessageQueue()
+        loop_count = [0]
 
-        class CounterLooper(Looper):
-            def main(self):
-                loop_counter.increment()
+        def count_loop():
+            loop_count[0] += 1
 
-            def on_shut_down(self, queue: MessageQueue, msg: str):
-                queue.push(msg)
+        def push_to_queue(msg: str, queue: MessageQueue, kwarg_msg: str):
+            queue.push(msg)
+            queue.push(kwarg_msg)
 
-        kw = {'msg': 'All done!', 'queue': msg_queue}
-        counter_looper = CounterLooper(interval=0.1, shut_down_kwargs=kw)
+        counter_looper = _ConfigurableLooper(interval=INTERVAL, shut_down_args=['Finished!'],
+                                             shut_down_kwargs={'queue': msg_queue, 'kwarg_msg': 'All done!'},
+                                             clock=clock, main_fn=count_loop, shut_down_fn=push_to_queue)
         # calls counter_looper.on_start_up, calls main once immediately, and then enters loop
         counter_looper.start()
-        # assert the message queue is empty
-        self.assertRaises(IndexError, msg_queue.pop)
-        # give time to allow for 4 loops
-        time.sleep(0.45)
+        # advance the clock to allow for LOOPS loops
+        for _ in range(LOOPS):
+            clock.advance(INTERVAL)
+        cls.empty_before_stop = len(msg_queue) == 0
         # calls on_shut_down
         counter_looper.stop()
-        self.assertEqual(5, loop_counter.count)
-        # msg was added to queue on shutdown
-        self.assertEqual('All done!', msg_queue.pop())
-
-    def test_with_main_args(self):
-
-        def message_generator():
-            msg_count = itertools.count(1)
-            while True:
-                yield f'Message {next(msg_count)}'
-
-        class MessageLooper(Looper):
-            _interval = 0.2
-
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-                self.message_queue = MessageQueue()
+        cls.messages = drain(msg_queue)
+        cls.loop_count = loop_count[0]
 
-            def main(self, get_msg: Iterator):
-                self.message_queue.push(next(get_msg))
+    def test_on_shutdown_with_args(self):
+        # the message queue was empty until shutdown
+        self.assertTrue(self.empty_before_stop)
+        self.assertEqual(LOOPS + 1, self.loop_count)
+        # msg from shut_down_args was added to queue on shutdown
+        self.assertEqual('Finished!', self.messages[0])
 
-        message_looper = MessageLooper(message_generator())
-        message_looper.start()
-        time.sleep(0.9)
-        message_looper.stop()
+    def test_on_shutdown_with_kwargs(self):
+        self.assertEqual(2, len(self.messages))
+        # msg from shut_down_kwargs was added to queue on shutdown
+        self.assertEqual('All done!', self.messages[1])
+
+
+class TestLooperMainArgs(unittest.TestCase):
+    """Steps one looper each for main args and kwargs in setUpClass, without starting the loop thread, tests assert on
+    the cached messages"""
+    messages: Dict[str, Tuple[str, ...]]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.messages = {}
+        variants: Dict[str, Tuple[List[Any], Dict[str, Any]]] = {
+            'args': ([message_generator()], {}),
+            'kwargs': ([], {'get_msg': message_generator()}),
+        }
+        for variant, (main_args, main_kwargs) in variants.items():
+            message_queue = MessageQueue()
+
+            def push_next_message(get_msg: Iterator, queue: MessageQueue = message_queue):
+                queue.push(next(get_msg))
+
+            message_looper = _ConfigurableLooper(*main_args, main_fn=push_next_message, **main_kwargs)
+            # the same calls to main as start, LOOPS loops and stop with run_before_first_wait == True
+            for _ in range(LOOPS + 1):
+                message_looper._run_one_iteration()
+            cls.messages[variant] = drain(message_queue)
+
+    def _assert_messages(self, variant: str) -> None:
         # msg was added to queue each loop
-        self.assertEqual('Message 1', message_looper.message_queue.pop())
-        self.assertEqual('Message 2', message_looper.message_queue.pop())
-        self.assertEqual('Message 3', message_looper.message_queue.pop())
-        self.assertEqual('Message 4', message_looper.message_queue.pop())
-        self.assertEqual('Message 5', message_looper.message_queue.pop())
-        self.assertRaises(IndexError, message_looper.message_queue.pop)
-
-    def test_with_main_kwargs(self):
-
-        def message_generator():
-            msg_count = itertools.count(1)
-            while True:
-                yield f'Message {next(msg_count)}'
+        expected = tuple(f'Message {msg_number}' for msg_number in range(1, LOOPS + 2))
+        self.assertEqual(expected, self.messages[variant])
 
-        class MessageLooper(Looper):
-            _interval = 0.2
+    def test_with_main_args(self):
+        self._assert_messages('args')
 
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-                self.message_queue = MessageQueue()
+    def test_with_main_kwargs(self):
+        self._assert_messages('kwargs')
 
-            def main(self, get_msg: Iterator):
-                self.message_queue.push(next(get_msg))
 
-        message_looper = MessageLooper(get_msg=message_generator())
-        message_looper.start()
-        time.sleep(0.9)
-        message_looper.stop()
-        # msg was added to queue each loop
-        self.assertEqual('Message 1', message_looper.message_queue.pop())
-        self.assertEqual('Message 2', message_looper.message_queue.pop())
-        self.assertEqual('Message 3', message_looper.message_queue.pop())
-        self.assertEqual('Message 4', message_looper.message_queue.pop())
-        self.assertEqual('Message 5', message_looper.message_queue.pop())
-        self.assertRaises(IndexError, message_looper.message_queue.pop)
+class TestMessageQueue(unittest.TestCase):
+    def test_grows_past_initial_capacity(self):
+        msg_queue = MessageQueue()
+        # offset head and tail from 0 so that the buffer wraps around before it grows
+        msg_queue.push('Message 0')
+        msg_queue.pop()
+        messages = [f'Message {msg_number}' for msg_number in range(1, 41)]
+        for msg in messages:
+            msg_queue.push(msg)
+        self.assertEqual(40, len(msg_queue))
+        self.assertEqual(tuple(messages), drain(msg_queue))
+        self.assertRaises(IndexError, msg_queue.pop)